@@ -0,0 +1,293 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import pytest
+
+from timer import SharedTimerTable, Timer, debug_timer
+
+
+def test_contextmanager_receives_exception():
+    seen = []
+
+    @contextmanager
+    @debug_timer.decorator("cm", per_yield=True)
+    def cm():
+        try:
+            yield
+        except ValueError as e:
+            seen.append(e)
+
+    with cm():
+        raise ValueError("body")
+    assert [str(e) for e in seen] == ["body"]
+    assert debug_timer.timers["cm"].calls == 1
+
+
+def test_asynccontextmanager_receives_exception():
+    seen = []
+
+    @asynccontextmanager
+    @debug_timer("acm")
+    async def acm():
+        try:
+            yield
+        except ValueError as e:
+            seen.append(e)
+
+    async def main():
+        async with acm():
+            raise ValueError("body")
+
+    asyncio.run(main())
+    assert [str(e) for e in seen] == ["body"]
+    assert debug_timer.timers["acm"].calls == 1
+
+
+def test_contextmanager_reraises():
+
+    @contextmanager
+    @debug_timer.decorator("cm_reraise", per_yield=True)
+    def cm():
+        yield
+
+    try:
+        with cm():
+            raise KeyError("body")
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("KeyError was swallowed")
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now_ns = 0
+
+    def __call__(self):
+        return self.now_ns
+
+    def sleep(self, seconds):
+        self.now_ns += int(seconds * 1e9)
+
+
+@pytest.fixture
+def clock():
+    """
+    The debug timer on a fake clock, restored to its defaults afterwards.
+    """
+    clock = FakeClock()
+    debug_timer._reset_shards()
+    debug_timer.set_clock(clock)
+    yield clock
+    debug_timer._reset_shards()
+    debug_timer.set_batched(False)
+    debug_timer.set_sync_func(lambda: None)
+    debug_timer.set_clock(time.perf_counter_ns)
+    debug_timer.calls = 0
+
+
+def test_batched_untimed_work_is_not_attributed(clock):
+    debug_timer.set_batched(True)
+    for _ in range(3):
+        with debug_timer("fwd"):
+            clock.sleep(0.002)
+        clock.sleep(0.020)
+        debug_timer.log(1, log_func=lambda line: None)
+    timer = debug_timer.timers["fwd"]
+    assert timer.calls == 3
+    assert list(timer.deque) == [2000000] * 3
+
+
+def test_batched_spreads_the_sync_over_the_step(clock):
+    debug_timer.set_batched(True)
+    debug_timer.set_sync_func(lambda: clock.sleep(0.010))
+    for _ in range(2):
+        with debug_timer("fwd"):
+            clock.sleep(0.002)
+        clock.sleep(0.020)
+        debug_timer.log(1, log_func=lambda line: None)
+    # the 10ms drain is spread over the 22ms of host time of each step
+    assert list(debug_timer.timers["fwd"].deque) == [2909090] * 2
+
+
+def test_batched_flushes_worker_threads(clock):
+    debug_timer.set_batched(True)
+
+    def worker():
+        for _ in range(100):
+            with debug_timer("w"):
+                clock.sleep(0.001)
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    debug_timer.log(1, log_func=lambda line: None)
+    timer = debug_timer.timers["w"]
+    assert timer.calls == 100
+    assert timer.global_avg == pytest.approx(0.001)
+    assert all(not spans for spans in debug_timer._span_shards)
+
+
+def test_decorating_adds_no_timer(clock):
+
+    @debug_timer("decorated")
+    def f():
+        clock.sleep(0.001)
+
+    assert len(debug_timer.timers) == 0
+    debug_timer.set_window_size(10)
+    f()
+    assert debug_timer.timers["decorated"].calls == 1
+    debug_timer._reset_shards()
+    debug_timer.set_window_size(50)
+
+
+def test_with_around_await_in_interleaved_tasks():
+    # the first task exits while the second is still inside its block
+    async def span(delay):
+        await asyncio.sleep(delay)
+        with debug_timer("interleaved"):
+            await asyncio.sleep(0.030)
+
+    async def main():
+        await asyncio.gather(span(0.), span(0.020))
+
+    asyncio.run(main())
+    for diff in debug_timer.timers["interleaved"].deque:
+        assert diff == pytest.approx(0.030e9, rel=0.3)
+
+
+def test_tree_extrapolates_sampled_timers(clock):
+    debug_timer.set_tree(True)
+    debug_timer.set_sampling("inner", every=2)
+    try:
+        for _ in range(10):
+            with debug_timer("outer"):
+                clock.sleep(0.0001)
+                with debug_timer("inner"):
+                    clock.sleep(0.001)
+        tree = debug_timer.timer_tree
+        lines = []
+        debug_timer.log(1, log_func=lines.append)
+    finally:
+        debug_timer._sampling.clear()
+        debug_timer.set_tree(False)
+    assert tree[("outer",)]["calls"] == 10
+    assert tree[("outer",)]["exclusive"] == pytest.approx(0.001)
+    assert tree[("outer", "inner")]["calls"] == 10
+    assert tree[("outer", "inner")]["sampled"] == 5
+    assert tree[("outer", "inner")]["inclusive"] == pytest.approx(0.010)
+    assert lines == ["outer: 1.100ms (self 0.100ms)\n"
+                     "  inner: 1.000ms (self 1.000ms) (total 0.010s over 10 calls)"]
+
+
+def test_reset_timer_clears_the_tree(clock):
+    debug_timer.set_tree(True)
+    try:
+        with debug_timer("outer"):
+            with debug_timer("inner"):
+                clock.sleep(0.001)
+        debug_timer.reset_timer()
+        with debug_timer("outer"):
+            clock.sleep(0.002)
+        tree = debug_timer.timer_tree
+    finally:
+        debug_timer.set_tree(False)
+    assert tree[("outer",)] == dict(calls=1, sampled=1, inclusive=0.002, exclusive=0.002)
+    assert ("outer", "inner") not in tree
+
+
+def test_sketch_is_opt_in(clock):
+    for ms in range(1, 101):
+        with debug_timer("q"):
+            clock.sleep(ms * 1e-3)
+    # without a sketch, quantiles are read from the 50-sample window
+    assert debug_timer.timers["q"].sketch is None
+    assert debug_timer.timers["q"].p50 == pytest.approx(0.0755)
+    debug_timer._reset_shards()
+    debug_timer.set_sketch(True)
+    try:
+        for ms in range(1, 101):
+            with debug_timer("q"):
+                clock.sleep(ms * 1e-3)
+        assert debug_timer.timers["q"].p50 == pytest.approx(0.050, rel=0.03)
+    finally:
+        debug_timer._reset_shards()
+        debug_timer.set_sketch(False)
+
+
+def recurse(clock, n):
+    clock.sleep(0.001)
+    if n:
+        recurse(clock, n - 1)
+
+
+def catching():
+    try:
+        yield 1
+    except ValueError:
+        yield -1
+
+
+def test_profile_recursion_and_throw(clock):
+    with debug_timer.profile(recurse, catching):
+        recurse(clock, 2)
+        gen = catching()
+        next(gen)
+        gen.throw(ValueError)
+        gen.close()
+    timer = debug_timer.timers["test_timer.recurse"]
+    # timed once, from the outermost activation
+    assert timer.calls == 1
+    assert timer.total_time == pytest.approx(0.003)
+    # next, throw and close each resume the generator
+    assert debug_timer.timers["test_timer.catching"].calls == 3
+
+
+def test_log_interval_follows_the_clock(clock):
+    clock.now_ns = 10 ** 15  # an origin far from perf_counter_ns
+    debug_timer.set_clock(clock)
+    lines = []
+    for _ in range(10):
+        with debug_timer("step"):
+            clock.sleep(1.)
+        debug_timer.log(log_func=lines.append, interval=2.5)
+    # due after 3s, 6s and 9s
+    assert lines == ["| step: 1.000s |"] * 3
+
+
+def test_time_window(clock):
+    debug_timer.set_time_window(10., buckets=10)
+    try:
+        for ms in (1, 2, 3):
+            with debug_timer("recent"):
+                clock.sleep(ms * 1e-3)
+            clock.sleep(4.)
+        timer = debug_timer.timers["recent"]
+        # 12s in, the first sample has left the window
+        assert timer.recent_calls == 2
+        assert timer.recent_avg == pytest.approx(0.0025)
+        assert timer.recent_max == pytest.approx(0.003)
+        assert timer.global_avg == pytest.approx(0.002)
+    finally:
+        debug_timer._reset_shards()
+        debug_timer.set_time_window(None)
+
+
+def test_shared_table_skips_a_slot_left_mid_write():
+    table = SharedTimerTable(create=True, num_slots=2)
+    try:
+        timer = Timer()
+        timer.add(1000)
+        for slot in (0, 1):
+            table.claim(slot)
+            table.write(slot, {"t": timer})
+        table.header["seq"][1] += 1  # a writer died in write()
+        assert table.read(1, timeout=0.01) is None
+        assert table.timers()["t"].calls == 1
+    finally:
+        table.close()
+        table.unlink()
@@ -1,56 +1,1613 @@
 """ https://github.com/flytocc/debug-timer
 """
 
+import fnmatch
+import inspect
+import json
+import math
+import os
+import random
+import sys
+import threading
 import time
 from collections import defaultdict, deque
-from functools import partial
+from contextvars import ContextVar
+from functools import partial, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
 from typing import Callable
 
 import numpy as np
 
+NS = 1e-9
+
+# Start times of `with` and `async with` blocks, kept per task since
+# coroutines interleave on the same thread and would overwrite
+# Timer.start_ns.
+_start_stack = ContextVar("debug_timer_start_stack", default=())
+# Names of the timers currently running, used to build the timer tree.
+_timer_path = ContextVar("debug_timer_path", default=())
+# Pending event markers and batched spans are appended by the owning thread
+# and may be resolved by another (a reporter, a flush), which must not
+# resolve them twice.
+_resolve_lock = threading.Lock()
+
+
+def _format_time(seconds):
+    if seconds < 0.01:
+        return "{:.3f}ms".format(seconds * 1000)
+    return "{:.3f}s".format(seconds)
+
+
+class QuantileSketch(object):
+    """
+    A DDSketch style streaming quantile sketch. Samples are bucketed on a
+    logarithmic scale, so quantiles over the whole run have bounded relative
+    error and use bounded memory however many samples were added.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._inv_log_gamma = 1. / math.log(self.gamma)
+        self.reset()
+
+    def reset(self):
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = math.ceil(math.log(value) * self._inv_log_gamma)
+        buckets = self.buckets
+        buckets[key] = buckets.get(key, 0) + 1
+        if len(buckets) > self.max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        # fold the lowest buckets together, the tail is what matters
+        keys = sorted(self.buckets)
+        extra = len(keys) - self.max_buckets
+        for key in keys[:extra]:
+            self.buckets[keys[extra]] += self.buckets.pop(key)
+
+    def merge(self, other):
+        assert self.gamma == other.gamma
+        self.count += other.count
+        self.zero_count += other.zero_count
+        buckets = self.buckets
+        # a snapshot, `other` may be updated by another thread meanwhile
+        for key, n in list(other.buckets.items()):
+            buckets[key] = buckets.get(key, 0) + n
+        if len(buckets) > self.max_buckets:
+            self._collapse()
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def cumulative_counts(self, bounds):
+        """
+        Number of samples at or below each of the ascending `bounds`.
+        """
+        keys = np.array(sorted(self.buckets), dtype=np.float64)
+        counts = np.cumsum([self.buckets[key] for key in sorted(self.buckets)])
+        values = 2 * self.gamma ** keys / (self.gamma + 1)
+        index = np.searchsorted(values, bounds, side="right")
+        return [self.zero_count + (int(counts[i - 1]) if i else 0) for i in index]
+
+
+class LogLinearHistogram(object):
+    """
+    An HDR style log-linear histogram of integer samples. Values below
+    2**sub_bucket_bits are counted exactly; above, every power of two is
+    split into 2**(sub_bucket_bits - 1) linear sub-buckets, which bounds the
+    relative error by 2**(1 - sub_bucket_bits). Counters live in one
+    preallocated int64 array, so adding is O(1) and histograms with the same
+    layout merge and subtract elementwise.
+    """
+
+    def __init__(self, sub_bucket_bits=7, max_bits=44):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.max_bits = max_bits
+        self.sub_buckets = 1 << sub_bucket_bits
+        self.half = self.sub_buckets >> 1
+        self.counts = np.zeros(
+            self.sub_buckets + (max_bits - sub_bucket_bits) * self.half, dtype=np.int64)
+        self.max_index = len(self.counts) - 1
+        self.count = 0
+
+    def index(self, value):
+        if value < self.sub_buckets:
+            return max(value, 0)
+        shift = value.bit_length() - self.sub_bucket_bits
+        index = self.sub_buckets + (shift - 1) * self.half + (value >> shift) - self.half
+        return min(index, self.max_index)
+
+    def lower_bound(self, index):
+        if index < self.sub_buckets:
+            return index
+        shift, offset = divmod(index - self.sub_buckets, self.half)
+        return (offset + self.half) << (shift + 1)
+
+    def add(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+
+    def copy(self):
+        other = LogLinearHistogram(self.sub_bucket_bits, self.max_bits)
+        other.counts[:] = self.counts
+        other.count = self.count
+        return other
+
+    def merge(self, other):
+        assert len(self.counts) == len(other.counts)
+        self.counts += other.counts
+        self.count += other.count
+        return self
+
+    def subtract(self, other):
+        """
+        The samples added since the snapshot `other` (a copy() taken earlier).
+        """
+        assert len(self.counts) == len(other.counts)
+        delta = self.copy()
+        delta.counts -= other.counts
+        delta.count -= other.count
+        return delta
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.
+        rank = q * (self.count - 1)
+        index = int(np.searchsorted(np.cumsum(self.counts), rank, side="right"))
+        low = self.lower_bound(index)
+        high = self.lower_bound(index + 1) if index < self.max_index else low + 1
+        return (low + high - 1) / 2
+
+
+class EventBackend(object):
+    """
+    Interface of a timing event backend. Instead of syncing the device around
+    every tic/toc, a backend records opaque markers into its queue; elapsed
+    times are resolved lazily, in batch, when the stats are read.
+    """
+
+    def record(self):
+        """
+        Record a marker and return it.
+        """
+        raise NotImplementedError
+
+    def wait(self, marker):
+        """
+        Block until `marker` (and every marker recorded before it) completed.
+        """
+        raise NotImplementedError
+
+    def elapsed_ns(self, start, end):
+        """
+        Integer nanoseconds between two completed markers.
+        """
+        raise NotImplementedError
+
+
+class CPUEventBackend(EventBackend):
+    """
+    Reference backend whose markers are host clock readings.
+    """
+
+    def __init__(self, clock=time.perf_counter_ns):
+        self.clock = clock
+
+    def record(self):
+        return self.clock()
+
+    def wait(self, marker):
+        pass
+
+    def elapsed_ns(self, start, end):
+        return end - start
+
+
+class CudaEventBackend(EventBackend):
+    """
+    Backend on torch.cuda.Event, the timings stay on the device queue.
+    """
+
+    def __init__(self):
+        import torch
+        self.torch = torch
+
+    def record(self):
+        event = self.torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def wait(self, marker):
+        marker.synchronize()
+
+    def elapsed_ns(self, start, end):
+        return int(start.elapsed_time(end) * 1e6)
+
+
+class RingBuffer(object):
+    """
+    A fixed size window of integer samples backed by a preallocated array.
+    Reductions read a view of the array, so no per-read copy is made.
+    """
+
+    def __init__(self, maxlen, dtype=np.int64):
+        self.maxlen = maxlen
+        self.array = np.zeros(maxlen, dtype=dtype)
+        self.index = 0
+        self.size = 0
+
+    def append(self, value):
+        self.array[self.index] = value
+        self.index = (self.index + 1) % self.maxlen
+        if self.size < self.maxlen:
+            self.size += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def view(self):
+        # samples out of order, which is fine for mean/median/max
+        return self.array[:self.size]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.view() if dtype is None else self.view().astype(dtype)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if self.size < self.maxlen:
+            return iter(self.array[:self.size].tolist())
+        return iter(np.roll(self.array, -self.index).tolist())
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("RingBuffer index out of range")
+        return int(self.array[(self.index - self.size + index) % self.maxlen])
+
+
+def _resolved(func):
+    """
+    A Timer property which first resolves the pending event markers.
+    """
+    @wraps(func)
+    def getter(self):
+        if self.pending:
+            self.resolve()
+        return func(self)
+    return property(getter)
+
 
 class Timer(object):
     """
     A timer which computes the time elapsed since the tic/toc of the timer.
+    Samples are kept as integer nanoseconds read from `clock`; the stats
+    properties report seconds.
     """
 
-    def __init__(self, window_size=20):
-        self.deque = deque(maxlen=window_size)
-        self.start_time = 0.
-        self.total_time = 0.
+    def __init__(self, window_size=20, clock=time.perf_counter_ns,
+                 relative_accuracy=0.01, ring_buffer=False, overhead_ns=0,
+                 events=None, histogram=False, time_window=None, time_buckets=60,
+                 sketch=False):
+        self.window_size = window_size
+        self.clock = clock
+        # an EventBackend, then tic/toc only record markers into `pending`
+        self.events = events
+        self.pending = []
+        # measured cost of an empty tic/toc, subtracted from every sample
+        self.overhead_ns = overhead_ns
+        self.ring_buffer = ring_buffer
+        # a log and a dict update per sample, so only on request
+        self.sketch = QuantileSketch(relative_accuracy) if sketch else None
+        self.histogram = LogLinearHistogram() if histogram else None
+        # a window over the last `time_window` seconds, in `time_buckets`
+        # ring slots each holding the calls, sum and max of one time slice
+        self.time_window = time_window
+        self.time_buckets = time_buckets
+        if time_window is not None:
+            self.bucket_ns = max(int(time_window / NS) // time_buckets, 1)
+        self.set_sampling()
+        self.reset()
+
+    def reset(self):
+        self.deque = RingBuffer(self.window_size) if self.ring_buffer \
+            else deque(maxlen=self.window_size)
+        if self.sketch is not None:
+            self.sketch.reset()
+        if self.histogram is not None:
+            self.histogram.reset()
+        self.pending = []
+        self.start_ns = 0
+        self.total_ns = 0
         self.calls = 0
+        self.skipped = 0
+        self.sampled = True
+        # running stats of the whole run (Welford) and of the window
+        self.mean_ns = 0.
+        self.m2_ns = 0.
+        self.min_ns = 0
+        self.max_ns = 0
+        self.window_ns = 0
+        self.window_max = deque()
+        if self.time_window is not None:
+            self.epochs = [-1] * self.time_buckets
+            self.bucket_calls = [0] * self.time_buckets
+            self.bucket_sums = [0] * self.time_buckets
+            self.bucket_maxs = [0] * self.time_buckets
+
+    def set_sampling(self, every=1, probability=None):
+        """
+        Time only one in `every` calls, or each call with `probability`.
+        Skipped calls are only counted, see `total_calls`.
+        """
+        assert every >= 1
+        assert probability is None or 0. < probability <= 1.
+        self.sample_every = every
+        self.sample_probability = probability
+        self.sampling = every > 1 or probability is not None
+        self._seen = 0
+
+    def should_sample(self):
+        if self.sample_probability is not None:
+            sampled = random.random() < self.sample_probability
+        else:
+            sampled = self._seen % self.sample_every == 0
+            self._seen += 1
+        if not sampled:
+            self.skipped += 1
+        return sampled
+
+    def mark(self):
+        """
+        Current clock reading, or a new event marker with an event backend.
+        """
+        if self.events is not None:
+            return self.events.record()
+        # perf_counter_ns is monotonic and high resolution, unlike time.time
+        # which may jump under NTP slews
+        return self.clock()
 
     def tic(self):
-        # using time.time instead of time.clock because time time.clock
-        # does not normalize for multithreading
-        self.start_time = time.time()
+        self.start_ns = self.mark()
 
-    def toc(self):
-        diff = time.time() - self.start_time
-        self.total_time += diff
+    def toc(self, start_ns=None):
+        """
+        Record a sample and return it in seconds. With an event backend,
+        return the pending (start, end, end_ns) entry instead.
+        """
+        if start_ns is None:
+            start_ns = self.start_ns
+        if self.events is not None:
+            # the host time of the end buckets the sample in the time window
+            end_ns = self.clock() if self.time_window is not None else None
+            entry = (start_ns, self.events.record(), end_ns)
+            self.pending.append(entry)
+            return entry
+        end_ns = self.clock()
+        diff = max(end_ns - start_ns - self.overhead_ns, 0)
+        self.add(diff, end_ns)
+        return diff * NS
+
+    def resolve(self):
+        """
+        Turn the pending event markers into samples, waiting once for the
+        latest of them.
+        """
+        with _resolve_lock:
+            # consume in place, the owner may append meanwhile
+            pending = self.pending[:len(self.pending)]
+            del self.pending[:len(pending)]
+            if not pending:
+                return
+            events = self.events
+            events.wait(pending[-1][1])
+            for start, end, end_ns in pending:
+                self.add(max(events.elapsed_ns(start, end) - self.overhead_ns, 0), end_ns)
+
+    def add(self, diff, end_ns=None):
+        """
+        Record a sample of `diff` nanoseconds, which ended at clock time
+        `end_ns` (now when None).
+        """
+        self.total_ns += diff
         self.calls += 1
-        self.deque.append(diff)
-        return diff
+        calls = self.calls
+        delta = diff - self.mean_ns
+        self.mean_ns += delta / calls
+        self.m2_ns += delta * (diff - self.mean_ns)
+        if diff < self.min_ns or calls == 1:
+            self.min_ns = diff
+        if diff > self.max_ns:
+            self.max_ns = diff
 
-    @property
+        window = self.deque
+        if len(window) == self.window_size:
+            self.window_ns -= window[0]
+        window.append(diff)
+        self.window_ns += diff
+        # monotonic deque of (call index, sample), its head is the window max
+        window_max = self.window_max
+        while window_max and window_max[-1][1] <= diff:
+            window_max.pop()
+        window_max.append((calls, diff))
+        if window_max[0][0] <= calls - self.window_size:
+            window_max.popleft()
+
+        if self.sketch is not None:
+            self.sketch.add(diff)
+        if self.histogram is not None:
+            self.histogram.add(diff)
+        if self.time_window is not None:
+            self._add_recent(diff, self.clock() if end_ns is None else end_ns)
+
+    def _add_recent(self, diff, end_ns):
+        epoch = end_ns // self.bucket_ns
+        slot = epoch % self.time_buckets
+        if self.epochs[slot] != epoch:
+            if self.epochs[slot] > epoch:
+                return  # resolved late, its slice already left the window
+            self.epochs[slot] = epoch
+            self.bucket_calls[slot] = 0
+            self.bucket_sums[slot] = 0
+            self.bucket_maxs[slot] = 0
+        self.bucket_calls[slot] += 1
+        self.bucket_sums[slot] += diff
+        if diff > self.bucket_maxs[slot]:
+            self.bucket_maxs[slot] = diff
+
+    def _recent_slots(self):
+        oldest = self.clock() // self.bucket_ns - self.time_buckets
+        return [slot for slot, epoch in enumerate(self.epochs) if epoch > oldest]
+
+    @_resolved
+    def total_time(self):
+        return self.total_ns * NS
+
+    @_resolved
+    def total_calls(self):
+        return self.calls + self.skipped
+
+    @_resolved
+    def estimated_total_time(self):
+        """
+        Total time extrapolated from the sampled calls to all calls.
+        """
+        if not self.calls:
+            return 0.
+        return self.total_ns * NS * self.total_calls / self.calls
+
+    @_resolved
     def median(self):
-        return np.median(self.deque) if self.deque else 0.
+        return float(np.median(self.deque)) * NS if self.deque else 0.
 
-    @property
+    @_resolved
     def avg(self):
-        return np.mean(self.deque) if self.deque else 0.
+        return self.window_ns * NS / len(self.deque) if self.deque else 0.
 
-    @property
+    def quantile(self, q):
+        """
+        Quantile over the whole run, read from the sketch, or over the
+        window without one.
+        """
+        if self.pending:
+            self.resolve()
+        if self.sketch is None:
+            return float(np.quantile(self.deque, q)) * NS if self.deque else 0.
+        return self.sketch.quantile(q) * NS
+
+    @_resolved
+    def p50(self):
+        return self.quantile(0.5)
+
+    @_resolved
+    def p90(self):
+        return self.quantile(0.9)
+
+    @_resolved
+    def p99(self):
+        return self.quantile(0.99)
+
+    @_resolved
+    def p999(self):
+        return self.quantile(0.999)
+
+    @_resolved
     def global_avg(self):
-        return self.total_time / self.calls
+        return self.total_ns * NS / self.calls if self.calls else 0.
 
-    @property
+    @_resolved
     def max(self):
-        return max(self.deque) if self.deque else 0.
+        return self.window_max[0][1] * NS if self.window_max else 0.
 
-    @property
+    @_resolved
+    def global_min(self):
+        return self.min_ns * NS
+
+    @_resolved
+    def global_max(self):
+        return self.max_ns * NS
+
+    @_resolved
+    def variance(self):
+        return self.m2_ns * NS * NS / self.calls if self.calls else 0.
+
+    @_resolved
+    def std(self):
+        return math.sqrt(self.variance)
+
+    @_resolved
     def value(self):
-        return self.deque[-1] if self.deque else 0.
+        return self.deque[-1] * NS if self.deque else 0.
+
+    @_resolved
+    def recent_calls(self):
+        """
+        Calls within the time window.
+        """
+        return sum(self.bucket_calls[slot] for slot in self._recent_slots())
+
+    @_resolved
+    def recent_avg(self):
+        slots = self._recent_slots()
+        calls = sum(self.bucket_calls[slot] for slot in slots)
+        return sum(self.bucket_sums[slot] for slot in slots) * NS / calls if calls else 0.
+
+    @_resolved
+    def recent_max(self):
+        return max([self.bucket_maxs[slot] for slot in self._recent_slots()], default=0) * NS
+
+    @_resolved
+    def recent_rate(self):
+        """
+        Calls per second over the time window.
+        """
+        return self.recent_calls / self.time_window
+
+    def snapshot(self):
+        """
+        The aggregates as plain integers: calls, skipped calls, total, window
+        sum and window length. Another thread can take it while this timer
+        keeps running. With a time window, the window is the time window.
+        """
+        if self.pending:
+            self.resolve()
+        if self.time_window is not None:
+            slots = self._recent_slots()
+            return (self.calls, self.skipped, self.total_ns,
+                    sum(self.bucket_sums[slot] for slot in slots),
+                    sum(self.bucket_calls[slot] for slot in slots))
+        return (self.calls, self.skipped, self.total_ns, self.window_ns,
+                len(self.deque))
+
+    def merge(self, other):
+        """
+        Accumulate the samples of `other` into this timer.
+        """
+        if other.pending:
+            other.resolve()
+        self.skipped += other.skipped
+        if other.calls == 0:
+            return self
+        calls = self.calls + other.calls
+        delta = other.mean_ns - self.mean_ns
+        self.m2_ns += other.m2_ns + delta * delta * self.calls * other.calls / calls
+        self.mean_ns += delta * other.calls / calls
+        self.min_ns = min(self.min_ns, other.min_ns) if self.calls else other.min_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+        self.total_ns += other.total_ns
+        self.calls = calls
+        self._merge_window(other)
+        if other.sketch is not None:
+            if self.sketch is None:
+                self.sketch = QuantileSketch(other.sketch.relative_accuracy)
+            self.sketch.merge(other.sketch)
+        if other.histogram is not None:
+            if self.histogram is None:
+                self.histogram = other.histogram.copy()
+            else:
+                self.histogram.merge(other.histogram)
+        if self.time_window is not None and other.time_window is not None:
+            for slot, epoch in enumerate(other.epochs):
+                if epoch > self.epochs[slot]:
+                    self.epochs[slot] = epoch
+                    self.bucket_calls[slot] = other.bucket_calls[slot]
+                    self.bucket_sums[slot] = other.bucket_sums[slot]
+                    self.bucket_maxs[slot] = other.bucket_maxs[slot]
+                elif epoch == self.epochs[slot]:
+                    self.bucket_calls[slot] += other.bucket_calls[slot]
+                    self.bucket_sums[slot] += other.bucket_sums[slot]
+                    self.bucket_maxs[slot] = max(self.bucket_maxs[slot], other.bucket_maxs[slot])
+        return self
+
+    def _merge_window(self, other):
+        """
+        The merged window is the union of both windows, so neither side's
+        samples are pushed out: the sum and max combine the two windows'
+        aggregates, as in Reporter.report. A merged timer is a view to read.
+        """
+        # list() copies in one step, `other` may be running in another thread
+        samples = list(self.deque) + list(other.deque)
+        maxes = list(self.window_max)[:1] + list(other.window_max)[:1]
+        capacity = max(len(samples), self.window_size)
+        if self.ring_buffer:
+            self.deque = RingBuffer(capacity)
+            self.deque.extend(samples)
+        else:
+            self.deque = deque(samples, maxlen=capacity)
+        self.window_ns += other.window_ns
+        self.window_max = deque([(self.calls, max(diff for _, diff in maxes))]) \
+            if maxes else deque()
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+class _NullTimer(object):
+    """
+    Stand-in returned by a disabled debug_timer: a no-op context manager,
+    and a decorator which returns the function unwrapped.
+    """
+
+    def __call__(self, func):
+        return func
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+class SharedTimerTable(object):
+    """
+    Timer aggregates of several processes in a shared memory segment.
+
+    Each process owns one slot and overwrites it with its aggregates (calls,
+    total, min, max, mean, variance, skipped calls) on publish; a reporter
+    process reads a merged view. Slots are guarded by a sequence counter
+    which is odd while the owner writes, so neither side takes a lock.
+
+    Usage:
+        table = SharedTimerTable(create=True)         # reporter
+        debug_timer.share(SharedTimerTable(table.name), slot=rank)
+        ...
+        debug_timer.log_shared(table)
+    """
+
+    HEADER = np.dtype([("pid", np.int64), ("seq", np.int64), ("count", np.int64)])
+
+    def __init__(self, name=None, create=False, num_slots=64, max_timers=256,
+                 max_name_len=64):
+        self.row = np.dtype([
+            ("name", f"S{max_name_len}"), ("calls", np.int64),
+            ("skipped", np.int64), ("total_ns", np.int64), ("min_ns", np.int64),
+            ("max_ns", np.int64), ("mean_ns", np.float64), ("m2_ns", np.float64)])
+        self.num_slots = num_slots
+        self.max_timers = max_timers
+        self.max_name_len = max_name_len
+        header_size = self.HEADER.itemsize * num_slots
+        size = header_size + self.row.itemsize * num_slots * max_timers
+        kwargs = {}
+        if not create and sys.version_info >= (3, 13):
+            # only the creator may unlink the segment
+            kwargs["track"] = False
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size, **kwargs)
+        self.name = self.shm.name
+        self.header = np.ndarray((num_slots,), dtype=self.HEADER, buffer=self.shm.buf)
+        self.table = np.ndarray((num_slots, max_timers), dtype=self.row,
+                                buffer=self.shm.buf, offset=header_size)
+        if create:
+            self.header[:] = 0
+
+    def claim(self, slot=None):
+        """
+        Take `slot` for this process, or the first free one. Pass explicit
+        slots (eg. the rank) when processes start concurrently.
+        """
+        pid = os.getpid()
+        slots = range(self.num_slots) if slot is None else [slot]
+        for slot in slots:
+            if self.header["pid"][slot] in (0, pid):
+                self.header["pid"][slot] = pid
+                return slot
+        raise ValueError("No free slot in the shared timer table!")
+
+    def write(self, slot, timers):
+        # check before the sequence counter goes odd, a truncated name could
+        # collide with another or end mid-character
+        timers = list(timers.items())
+        if len(timers) > self.max_timers:
+            raise ValueError("{} timers do not fit the shared timer table, max_timers={}!".format(
+                len(timers), self.max_timers))
+        names = [name.encode() for name, _ in timers]
+        for name in names:
+            if len(name) > self.max_name_len:
+                raise ValueError("Timer name {!r} is longer than max_name_len={} bytes!".format(
+                    name.decode(), self.max_name_len))
+        seq, count, rows = self.header["seq"], self.header["count"], self.table[slot]
+        seq[slot] += 1
+        index = 0
+        for name, (_, timer) in zip(names, timers):
+            if timer.pending:
+                timer.resolve()
+            rows[index] = (name, timer.calls, timer.skipped, timer.total_ns,
+                           timer.min_ns, timer.max_ns, timer.mean_ns, timer.m2_ns)
+            index += 1
+        count[slot] = index
+        seq[slot] += 1
+
+    def read(self, slot, timeout=1.):
+        """
+        The timers of `slot`, or None if it is still being written after
+        `timeout` seconds, eg. its writer died mid-write.
+        """
+        seq = self.header["seq"]
+        deadline = time.monotonic() + timeout
+        while True:
+            before = int(seq[slot])
+            if before % 2 == 0:
+                rows = self.table[slot, :int(self.header["count"][slot])].copy()
+                if int(seq[slot]) == before:
+                    break
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0)
+        timers = {}
+        for row in rows:
+            timer = timers[row["name"].decode()] = Timer()
+            timer.calls, timer.skipped = int(row["calls"]), int(row["skipped"])
+            timer.total_ns, timer.min_ns = int(row["total_ns"]), int(row["min_ns"])
+            timer.max_ns, timer.mean_ns = int(row["max_ns"]), float(row["mean_ns"])
+            timer.m2_ns = float(row["m2_ns"])
+        return timers
+
+    def timers(self):
+        """
+        Merged view over every claimed slot, without the slots left
+        mid-write (see `read`).
+        """
+        timers = {}
+        for slot in np.flatnonzero(self.header["pid"]):
+            slot_timers = self.read(slot)
+            if slot_timers is None:
+                continue
+            for name, timer in slot_timers.items():
+                if name not in timers:
+                    timers[name] = Timer()
+                timers[name].merge(timer)
+        return timers
+
+    def close(self):
+        del self.header, self.table
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class Communicator(object):
+    """
+    Interface of the collective used to reduce timers across ranks.
+    """
+
+    rank = 0
+    world_size = 1
+
+    def gather(self, obj):
+        """
+        Collect `obj` from every rank; rank 0 gets the list ordered by rank,
+        the other ranks get None.
+        """
+        raise NotImplementedError
+
+
+class SocketCommunicator(Communicator):
+    """
+    Reference communicator over local sockets (multiprocessing.connection).
+    Rank 0 listens on `address`, the other ranks connect to it.
+    """
+
+    def __init__(self, rank, world_size, address=("127.0.0.1", 29555),
+                 authkey=b"debug_timer", timeout=60.):
+        self.rank = rank
+        self.world_size = world_size
+        self.conns = []
+        if rank == 0:
+            self.listener = Listener(address, authkey=authkey)
+            return
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                conn = Client(address, authkey=authkey)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        conn.send(rank)
+        self.conns = [conn]
+
+    def _accept(self):
+        conns = [None] * self.world_size
+        for _ in range(self.world_size - 1):
+            conn = self.listener.accept()
+            conns[conn.recv()] = conn
+        self.conns = conns[1:]
+
+    def gather(self, obj):
+        if self.rank != 0:
+            self.conns[0].send(obj)
+            return None
+        if len(self.conns) < self.world_size - 1:
+            self._accept()
+        return [obj] + [conn.recv() for conn in self.conns]
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+        if self.rank == 0:
+            self.listener.close()
+
+
+class TorchCommunicator(Communicator):
+    """
+    Communicator on an initialized torch.distributed process group.
+    """
+
+    def __init__(self, group=None):
+        import torch.distributed as dist
+        self.dist = dist
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+
+    def gather(self, obj):
+        objs = [None] * self.world_size if self.rank == 0 else None
+        self.dist.gather_object(obj, objs, dst=0, group=self.group)
+        return objs
+
+
+TRACE_DTYPE = np.dtype([
+    ("timer", np.int32), ("thread", np.int32), ("start_ns", np.int64), ("end_ns", np.int64)])
+
+
+class TraceRecorder(object):
+    """
+    Record every timed span as a (timer id, thread id, start_ns, end_ns)
+    row of TRACE_DTYPE. Each thread fills a preallocated buffer, full
+    buffers are copied into a memory-mapped file at `path` which grows by
+    `chunk_size` rows. close() trims the file and writes the timer and
+    thread names to `path + ".json"`, see `load_trace`.
+    """
+
+    def __init__(self, path, buffer_size=1 << 16, chunk_size=1 << 20):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.timer_ids = {}
+        self.thread_names = []
+        self.buffers = []
+        self.count = 0
+        self.capacity = 0
+        self.mmap = None
+        self.lock = threading.Lock()
+        self.file = open(path, "w+b")
+
+    def timer_id(self, name):
+        with self.lock:
+            return self.timer_ids.setdefault(name, len(self.timer_ids))
+
+    def new_buffer(self):
+        with self.lock:
+            thread = len(self.thread_names)
+            self.thread_names.append(threading.current_thread().name)
+            buffer = _TraceBuffer(self, thread)
+            self.buffers.append(buffer)
+        return buffer
+
+    def write(self, records):
+        with self.lock:
+            count = self.count + len(records)
+            if count > self.capacity:
+                self._grow(count)
+            self.mmap[self.count:count] = records
+            self.count = count
+
+    def _grow(self, count):
+        self.capacity = max(count, self.capacity + self.chunk_size)
+        if self.mmap is not None:
+            self.mmap.flush()
+        self.file.truncate(self.capacity * TRACE_DTYPE.itemsize)
+        self.mmap = np.memmap(self.file, dtype=TRACE_DTYPE, mode="r+",
+                              shape=(self.capacity,))
+
+    def flush(self):
+        """
+        Flush every thread's buffer, call it while no thread is timing.
+        """
+        for buffer in list(self.buffers):
+            buffer.flush()
+        if self.mmap is not None:
+            self.mmap.flush()
+
+    def close(self):
+        self.flush()
+        self.mmap = None
+        self.file.truncate(self.count * TRACE_DTYPE.itemsize)
+        self.file.close()
+        with open(self.path + ".json", "w") as f:
+            json.dump(self.names(), f)
+
+    def names(self):
+        return dict(timers=sorted(self.timer_ids, key=self.timer_ids.get),
+                    threads=list(self.thread_names))
+
+    def records(self):
+        """
+        The records written so far, flush() first to include the buffers.
+        """
+        if self.mmap is None:
+            return np.zeros(0, dtype=TRACE_DTYPE)
+        return self.mmap[:self.count]
+
+
+class _TraceBuffer(object):
+
+    def __init__(self, recorder, thread):
+        self.recorder = recorder
+        self.records = np.zeros(recorder.buffer_size, dtype=TRACE_DTYPE)
+        self.records["thread"] = thread
+        # column views, so recording only stores three integers
+        self.timers = self.records["timer"]
+        self.starts = self.records["start_ns"]
+        self.ends = self.records["end_ns"]
+        self.index = 0
+
+    def record(self, timer_id, start_ns, end_ns):
+        index = self.index
+        self.timers[index] = timer_id
+        self.starts[index] = start_ns
+        self.ends[index] = end_ns
+        self.index = index + 1
+        if self.index == self.recorder.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.index:
+            self.recorder.write(self.records[:self.index])
+            self.index = 0
+
+
+def load_trace(path):
+    """
+    Read a trace written by TraceRecorder: the records (memory-mapped) and
+    the dict of timer and thread names, indexed by the ids in the records.
+    """
+    with open(path + ".json") as f:
+        names = json.load(f)
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=TRACE_DTYPE), names
+    return np.memmap(path, dtype=TRACE_DTYPE, mode="r"), names
+
+
+def write_chrome_trace(records, names, path, chunk_size=1 << 16):
+    """
+    Write trace records as Chrome trace event JSON, which chrome://tracing
+    and Perfetto open. Spans become complete ("X") events on one track per
+    thread, where nesting follows from the timestamps, and a "calls"
+    counter tracks the cumulative calls of every timer. The records are
+    converted `chunk_size` at a time, so a memory-mapped trace is never
+    loaded as a whole.
+    """
+    pid = os.getpid()
+    timer_names = [json.dumps(name) for name in names["timers"]]
+    span = '{{"ph":"X","name":{},"pid":%d,"tid":{},"ts":{:.3f},"dur":{:.3f}}}' % pid
+    with open(path, "w") as f:
+        f.write('{"traceEvents":[\n')
+        for tid, name in enumerate(names["threads"]):
+            f.write(json.dumps(dict(ph="M", name="thread_name", pid=pid, tid=tid,
+                                    args=dict(name=name))) + ",\n")
+        calls = np.zeros(len(timer_names), dtype=np.int64)
+        for begin in range(0, len(records), chunk_size):
+            chunk = records[begin:begin + chunk_size]
+            timers, starts = chunk["timer"], chunk["start_ns"]
+            durations = (chunk["end_ns"] - starts).tolist()
+            for timer, tid, start_ns, duration_ns in zip(
+                    timers.tolist(), chunk["thread"].tolist(), starts.tolist(), durations):
+                f.write(span.format(timer_names[timer], tid, start_ns / 1000,
+                                    duration_ns / 1000))
+                f.write(",\n")
+            calls += np.bincount(timers, minlength=len(calls))
+            f.write(json.dumps(dict(
+                ph="C", name="calls", pid=pid, ts=int(chunk["end_ns"].max()) / 1000,
+                args=dict(zip(names["timers"], calls.tolist())))) + ",\n")
+        f.write(json.dumps(dict(ph="M", name="process_name", pid=pid,
+                                args=dict(name="debug_timer"))))
+        f.write("]}\n")
+
+
+class MetricsExporter(object):
+    """
+    Render the timers of a _DebugTimer in the OpenMetrics text format: a
+    histogram with `buckets` (seconds) and a summary with `quantiles`, both
+    read from the quantile sketches (see _DebugTimer.set_sketch) and
+    labelled by timer name.
+
+    The text of a timer is cached until its call count summed over the
+    thread shards changes, so a scrape only merges and re-renders the timers
+    which ran since the last one. They are merged into a fresh timer, so
+    rendering reads a copy and never blocks their tic/toc.
+    """
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+    def __init__(self, debug_timer, namespace="debug_timer",
+                 buckets=(1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1., 10.),
+                 quantiles=(0.5, 0.9, 0.99, 0.999)):
+        self.debug_timer = debug_timer
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.bounds_ns = np.array(self.buckets) / NS
+        self.quantiles = tuple(quantiles)
+        self.cache = {}
+
+    def render(self):
+        debug_timer = self.debug_timer
+        with debug_timer._lock:
+            shards = list(debug_timer._shards)
+        per_name = {}
+        for shard in shards:
+            for name, timer in list(shard.items()):
+                if timer.pending:
+                    timer.resolve()
+                per_name.setdefault(name, []).append(timer)
+        histograms, summaries = [], []
+        for name, timers in per_name.items():
+            calls = sum(timer.calls for timer in timers)
+            cached = self.cache.get(name)
+            if cached is None or cached[0] != calls:
+                merged = debug_timer._timer_obj()
+                for timer in timers:
+                    merged.merge(timer)
+                cached = self.cache[name] = (calls,) + self._render_timer(name, merged)
+            histograms.append(cached[1])
+            summaries.append(cached[2])
+        histogram = self.namespace + "_seconds"
+        summary = self.namespace + "_summary_seconds"
+        return "".join(
+            [f"# TYPE {histogram} histogram\n", f"# UNIT {histogram} seconds\n"] +
+            histograms +
+            [f"# TYPE {summary} summary\n", f"# UNIT {summary} seconds\n"] +
+            summaries + ["# EOF\n"])
+
+    def _render_timer(self, name, timer):
+        label = 'timer="{}"'.format(
+            name.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        histogram = self.namespace + "_seconds"
+        summary = self.namespace + "_summary_seconds"
+        total = "{}".format(timer.total_ns * NS)
+        lines = []
+        # without a sketch only the +Inf bucket is known
+        counts = timer.sketch.cumulative_counts(self.bounds_ns) \
+            if timer.sketch is not None else []
+        for bound, count in zip(self.buckets, counts):
+            lines.append(f'{histogram}_bucket{{{label},le="{bound}"}} {count}\n')
+        lines.append(f'{histogram}_bucket{{{label},le="+Inf"}} {timer.calls}\n')
+        lines.append(f"{histogram}_count{{{label}}} {timer.calls}\n")
+        lines.append(f"{histogram}_sum{{{label}}} {total}\n")
+        histogram_text = "".join(lines)
+        lines = []
+        for q in self.quantiles:
+            lines.append(f'{summary}{{{label},quantile="{q}"}} {timer.quantile(q)}\n')
+        lines.append(f"{summary}_count{{{label}}} {timer.calls}\n")
+        lines.append(f"{summary}_sum{{{label}}} {total}\n")
+        return histogram_text, "".join(lines)
+
+    def serve(self, port=9464, addr=""):
+        """
+        Serve the metrics over HTTP from a daemon thread, returns the server.
+        """
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+
+class Reporter(object):
+    """
+    Log the timers of a _DebugTimer from a daemon thread every `interval`
+    seconds, so formatting and `log_func` never run on the timed thread.
+    The reporter reads Timer.snapshot() of every timer in every thread's
+    shard. Each snapshot is a handful of attribute reads, so it may be off
+    by the sample being recorded at that moment, but it never blocks tic/toc.
+    """
+
+    def __init__(self, debug_timer, interval=10., prefix="", log_func=print):
+        self.debug_timer = debug_timer
+        self.interval = interval
+        self.prefix = prefix
+        self.log_func = log_func
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="debug_timer_reporter", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        debug_timer = self.debug_timer
+        prefix = self.prefix or debug_timer.prefix
+        if debug_timer.tree:
+            self.log_func(debug_timer._format_tree(prefix))
+            return
+        with debug_timer._lock:
+            shards = list(debug_timer._shards)
+        totals = {}
+        for shard in shards:
+            for name, timer in list(shard.items()):
+                snapshot = timer.snapshot()
+                total = totals.get(name)
+                totals[name] = snapshot if total is None else tuple(
+                    a + b for a, b in zip(total, snapshot))
+        if not totals:
+            return
+        windowed = debug_timer.window_size > 0
+        lines = [prefix]
+        for name, (calls, skipped, total_ns, window_ns, window_len) in totals.items():
+            if windowed:
+                avg_time = window_ns * NS / window_len if window_len else 0.
+            else:
+                avg_time = total_ns * NS / calls if calls else 0.
+            if skipped and calls:
+                lines.append(" {}: {} (total {} over {} calls) ".format(
+                    name, _format_time(avg_time),
+                    _format_time(total_ns * NS * (calls + skipped) / calls),
+                    calls + skipped))
+            else:
+                lines.append(" {}: {} ".format(name, _format_time(avg_time)))
+        lines.append("")
+        self.log_func("|".join(lines))
+
+
+class TimerHandle(object):
+    """
+    A timer of a _DebugTimer resolved once, on first use, see
+    _DebugTimer.handle. Its tic/toc and (async) context manager skip the
+    name lookup. `with` and `async with` keep their start times on the
+    calling task's stack, so nested, reentrant and interleaved blocks of
+    the same timer are timed correctly, even a `with` around an `await`.
+
+    Usage:
+        step = debug_timer.handle("step")
+        with step:
+            code
+    """
+
+    def __init__(self, owner, name, timer=None):
+        self.owner = owner
+        self.name = name
+        self.timer = timer
+        # nesting depth and outermost start of the FunctionProfiler activations
+        self.depth = 0
+        self.depth_start = None
+
+    def __call__(self, func):
+        return _timed(self.owner, self.name, func)
+
+    def start(self):
+        """
+        Tic, returning the start to pass to stop(), None if not timed.
+        """
+        if not self.owner.enabled:
+            return None
+        timer = self._timer()
+        self.owner._tic(self.name, timer)
+        return timer.start_ns if timer.sampled else None
+
+    def stop(self, start_ns):
+        if start_ns is not None:
+            return self.owner._toc(self.name, self._timer(), start_ns)
+        if self.owner.tree and self.owner.enabled:
+            self.owner._record_path(self.name, None)  # a skipped call
+
+    def _timer(self):
+        # created on first use, so decorating at import time adds no timer
+        timer = self.timer
+        if timer is None:
+            timer = self.timer = self.owner._shard()[self.name]
+        return timer
+
+    def tic(self):
+        owner = self.owner
+        if owner._plain:
+            # the common case inlined: only read the clock
+            timer = self.timer or self._timer()
+            if not timer.sampling:
+                timer.start_ns = timer.clock()
+                return timer
+            return owner._tic(self.name, timer)
+        if owner.enabled:
+            return owner._tic(self.name, self._timer())
+
+    def toc(self):
+        owner = self.owner
+        if owner._plain:
+            timer = self.timer or self._timer()
+            if not timer.sampling:
+                return timer.toc()
+            return owner._toc(self.name, timer)
+        if owner.enabled:
+            return owner._toc(self.name, self._timer())
+
+    def __enter__(self):
+        if self.owner.enabled:
+            self.owner._task_tic(self.name, self._timer())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owner.enabled:
+            self.owner._task_toc(self.name, self._timer())
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        return self.__exit__(exc_type, exc_value, traceback)
+
+
+def _timed(owner, name, func, per_yield=False):
+    """
+    Wrap `func` to be timed as `name`. Functions and coroutine functions
+    are timed per call; generator and async generator functions from their
+    first step until exhaustion (or close), and with `per_yield` every step
+    between two yields also goes to the timer `name + ".yield"`.
+    """
+    handle = owner.handle
+    yield_name = name + ".yield"
+
+    if inspect.isasyncgenfunction(func):
+        @wraps(func)
+        async def async_gen_wrapper(*args, **kwargs):
+            agen = func(*args, **kwargs)
+            start_ns = handle(name).start()
+            try:
+                value, error = None, None
+                while True:
+                    step = handle(yield_name) if per_yield else None
+                    step_ns = step.start() if per_yield else None
+                    try:
+                        if error is None:
+                            item = await agen.asend(value)
+                        else:
+                            item = await agen.athrow(error)
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        if per_yield:
+                            step.stop(step_ns)
+                    value, error = None, None
+                    # forward what the caller throws in, like `yield from`
+                    try:
+                        value = yield item
+                    except GeneratorExit:
+                        raise
+                    except BaseException as e:
+                        error = e
+            finally:
+                await agen.aclose()
+                handle(name).stop(start_ns)
+        return async_gen_wrapper
+
+    if inspect.isgeneratorfunction(func):
+        @wraps(func)
+        def gen_wrapper(*args, **kwargs):
+            gen = func(*args, **kwargs)
+            start_ns = handle(name).start()
+            try:
+                if not per_yield:
+                    return (yield from gen)
+                value, error = None, None
+                while True:
+                    step = handle(yield_name)
+                    step_ns = step.start()
+                    try:
+                        item = gen.send(value) if error is None else gen.throw(error)
+                    except StopIteration as stop:
+                        return stop.value
+                    finally:
+                        step.stop(step_ns)
+                    value, error = None, None
+                    # forward what the caller throws in, like `yield from`
+                    try:
+                        value = yield item
+                    except GeneratorExit:
+                        raise
+                    except BaseException as e:
+                        error = e
+            finally:
+                gen.close()
+                handle(name).stop(start_ns)
+        return gen_wrapper
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_func_wrapper(*args, **kwargs):
+            timer = handle(name)
+            start_ns = timer.start()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                timer.stop(start_ns)
+        return async_func_wrapper
+
+    @wraps(func)
+    def func_wrapper(*args, **kwargs):
+        timer = handle(name)
+        start_ns = timer.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer.stop(start_ns)
+    return func_wrapper
+
+
+def _qualname(func):
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+def _iter_functions(target, include=None, exclude=None):
+    """
+    Yield (owner, attribute, value, function) for the functions of a module
+    or class (recursing into the classes defined in a module) whose qualified
+    name matches the fnmatch patterns of `include` and not those of
+    `exclude`. Dunder methods are skipped.
+    """
+    include = [include] if isinstance(include, str) else include
+    exclude = [exclude] if isinstance(exclude, str) else exclude or []
+
+    def selected(func):
+        qualname = _qualname(func)
+        if include is not None and not any(fnmatch.fnmatchcase(qualname, p) for p in include):
+            return False
+        return not any(fnmatch.fnmatchcase(qualname, p) for p in exclude)
+
+    def iter_class(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("__") and attr.endswith("__"):
+                continue
+            func = value.__func__ if isinstance(value, (staticmethod, classmethod)) else value
+            if inspect.isfunction(func) and selected(func):
+                yield cls, attr, value, func
+
+    if inspect.isclass(target):
+        yield from iter_class(target)
+    else:
+        for attr, value in list(vars(target).items()):
+            if getattr(value, "__module__", None) != target.__name__:
+                continue
+            if inspect.isfunction(value) and selected(value):
+                yield target, attr, value, value
+            elif inspect.isclass(value):
+                yield from iter_class(value)
+
+
+class FunctionProfiler(object):
+    """
+    Time the selected functions of a _DebugTimer without wrapping them,
+    through sys.monitoring on Python 3.12+ (events are enabled only on the
+    selected code objects) or else sys.setprofile (and threading.setprofile
+    for threads started later). Each function is timed as its qualified
+    name, per activation: a generator is timed between resumes (or throws)
+    and yields. Recursive activations are timed once, from the outermost
+    one, so the inclusive time isn't counted twice. sys.monitoring takes
+    a free tool id, or falls back to sys.setprofile when there is none
+    (eg. cProfile running).
+    """
+
+    def __init__(self, debug_timer, targets, include=None, exclude=None,
+                 use_monitoring=None):
+        self.debug_timer = debug_timer
+        self.names = {}
+        for target in targets:
+            if inspect.isfunction(target):
+                funcs = [target]
+            else:
+                funcs = [func for _, _, _, func in _iter_functions(target, include, exclude)]
+            for func in funcs:
+                # unwrap instrumented or decorated functions
+                func = inspect.unwrap(func)
+                self.names[func.__code__] = _qualname(func)
+        if use_monitoring is None:
+            use_monitoring = hasattr(sys, "monitoring")
+        self.use_monitoring = use_monitoring
+        self.tool = None
+        self.running = False
+
+    def _start(self, code, *args):
+        name = self.names.get(code)
+        if name is not None:
+            handle = self.debug_timer.handle(name)
+            handle.depth += 1
+            if handle.depth == 1:
+                handle.depth_start = handle.start()
+
+    def _stop(self, code, *args):
+        name = self.names.get(code)
+        if name is not None:
+            handle = self.debug_timer.handle(name)
+            # an activation which started before the profiler isn't counted
+            if handle.depth:
+                handle.depth -= 1
+                if handle.depth == 0:
+                    handle.stop(handle.depth_start)
+
+    def _profile(self, frame, event, arg):
+        if not self.running:
+            # a thread started while running kept the hook, drop it
+            sys.setprofile(None)
+            return
+        if event == "call":
+            self._start(frame.f_code)
+        elif event == "return":
+            self._stop(frame.f_code)
+
+    def start(self):
+        assert not self.running
+        self.running = True
+        if self.use_monitoring:
+            self.tool = self._free_tool()
+        if self.tool is None:
+            threading.setprofile(self._profile)
+            sys.setprofile(self._profile)
+            return self
+        monitoring = sys.monitoring
+        events = monitoring.events
+        tool = self.tool
+        monitoring.use_tool_id(tool, "debug_timer")
+        monitoring.register_callback(tool, events.PY_START, self._start)
+        monitoring.register_callback(tool, events.PY_RESUME, self._start)
+        monitoring.register_callback(tool, events.PY_THROW, self._start)
+        monitoring.register_callback(tool, events.PY_RETURN, self._stop)
+        monitoring.register_callback(tool, events.PY_YIELD, self._stop)
+        monitoring.register_callback(tool, events.PY_UNWIND, self._stop)
+        local_events = events.PY_START | events.PY_RESUME | events.PY_RETURN | events.PY_YIELD
+        for code in self.names:
+            monitoring.set_local_events(tool, code, local_events)
+        # throws and unwinding can't be enabled per code object, the
+        # callbacks filter them
+        monitoring.set_events(tool, events.PY_THROW | events.PY_UNWIND)
+        return self
+
+    @staticmethod
+    def _free_tool():
+        monitoring = sys.monitoring
+        # the profiler id first, then the ids no tool is assigned to
+        for tool in (monitoring.PROFILER_ID, 3, 4):
+            if monitoring.get_tool(tool) is None:
+                return tool
+        return None
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.tool is None:
+            sys.setprofile(None)
+            threading.setprofile(None)
+            return
+        monitoring = sys.monitoring
+        events = monitoring.events
+        tool, self.tool = self.tool, None
+        monitoring.set_events(tool, events.NO_EVENTS)
+        for code in self.names:
+            monitoring.set_local_events(tool, code, events.NO_EVENTS)
+        for event in (events.PY_START, events.PY_RESUME, events.PY_THROW,
+                      events.PY_RETURN, events.PY_YIELD, events.PY_UNWIND):
+            monitoring.register_callback(tool, event, None)
+        monitoring.free_tool_id(tool)
+
+    def __enter__(self):
+        return self if self.running else self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+def _accessor(owner, name, is_tic):
+    """
+    The `debug_timer.<name>_tic`/`_toc` callable, dispatching to the
+    calling thread's TimerHandle. A closure, which calls faster than an
+    object with __call__.
+    """
+    method = TimerHandle.tic if is_tic else TimerHandle.toc
+
+    def accessor():
+        try:
+            handle = owner._local.handles[name]
+        except (AttributeError, KeyError):
+            handle = owner.handle(name)
+        return method(handle)
+    return accessor
+
+
+class _TimerShard(dict):
+    """
+    The timers of one thread, created on first use.
+    """
+
+    def __init__(self, owner):
+        super(_TimerShard, self).__init__()
+        self.owner = owner
+
+    def __missing__(self, name):
+        timer = self[name] = self.owner._new_timer(name)
+        return timer
 
 
 class _DebugTimer(object):
@@ -74,12 +1631,36 @@ class _DebugTimer(object):
            def func(*args, **kwargs):
                code4
 
+           async with debug_timer("timer5"):
+               await code5
+
         3. debug_timer.log()
+
+    Set DEBUG_TIMER=0 in the environment, or call debug_timer.disable(), to
+    turn every timer into a no-op. Functions decorated while disabled are
+    returned unwrapped and stay untimed.
     """
 
     __TIMER__ = None
     prefix = ""
     window_size = 50
+    ring_buffer = False
+    histogram = False
+    sketch = False
+    time_window = None
+    time_buckets = 60
+    tree = False
+    overhead_ns = 0
+    events = None
+    batched = False
+    shared = None
+    comm = None
+    trace = None
+    reporter = None
+    _blocking = True
+    _plain = False
+    enabled = os.environ.get("DEBUG_TIMER", "1").lower() not in ("0", "false", "off")
+    clock = staticmethod(time.perf_counter_ns)
 
     def __new__(cls, *args, **kwargs):
         if cls.__TIMER__ is None:
@@ -89,92 +1670,773 @@ class _DebugTimer(object):
     def __init__(self, num_warmup=0):
         super(_DebugTimer, self).__init__()
         self.num_warmup = num_warmup
-        self.context_stacks = []
         self.calls = 0
-        self.timers = defaultdict(Timer)
-        self.set_sync_func(lambda: None)
+        self._timer_obj = Timer
+        self._sampling = {}
+        self._instrumented = {}
+        self.metrics = MetricsExporter(self)
+        self._reset_shards()
+        self.set_sync_func(_noop)
         self.set_window_size(self.window_size)
+        self.set_enabled(self.enabled)
 
     def __getattr__(self, name):
         if name in self.__dict__:
             return self.__dict__[name]
-        elif name.endswith("_tic"):
-            return lambda: self.tic(name[:-4])
-        elif name.endswith("_toc"):
-            return lambda: self.toc(name[:-4])
+        elif not self.enabled and name.endswith(("_tic", "_toc")):
+            return _noop
+        elif name.endswith(("_tic", "_toc")):
+            # cached on the instance, so later lookups skip __getattr__
+            accessor = self.__dict__[name] = _accessor(self, name[:-4], name.endswith("_tic"))
+            return accessor
         raise AttributeError(name)
 
-    def __call__(self, name_or_func):
-        if isinstance(name_or_func, str):
-            self.context_stacks.append(name_or_func)
-            return self
+    def __call__(self, name):
+        """
+        The span of timer `name`: the calling thread's cached TimerHandle,
+        used as a (async) context manager or a decorator.
+        """
+        if not self.enabled:
+            return _null_timer
+        return self.handle(name)
 
-        name = self.context_stacks.pop(-1)
+    def _task_tic(self, name, timer):
+        if self._plain and not timer.sampling:
+            _start_stack.set(_start_stack.get() + (timer.clock(),))
+            return
+        if timer.sampling and not timer.should_sample():
+            _start_stack.set(_start_stack.get() + (None,))
+            if self.tree:
+                _timer_path.set(_timer_path.get() + (name,))
+            return
+        if self.tree:
+            _timer_path.set(_timer_path.get() + (name,))
+        if self._blocking:
+            self.sync()
+        _start_stack.set(_start_stack.get() + (timer.mark(),))
 
-        def func_wrapper(*args, **kwargs):
-            with self(name):
-                return name_or_func(*args, **kwargs)
-        return func_wrapper
+    def _task_toc(self, name, timer):
+        starts = _start_stack.get()
+        _start_stack.set(starts[:-1])
+        if starts[-1] is not None:
+            self._toc(name, timer, starts[-1])
+        elif self.tree:
+            self._record_path(name, None)
 
-    def __enter__(self):
-        name = self.context_stacks[-1]
-        self.tic(name)
-        return self
+    @property
+    def timers(self):
+        """
+        Merged view over the per-thread timer shards.
+        """
+        with self._lock:
+            shards = list(self._shards)
+        if len(shards) == 1:
+            return shards[0]
+        timers = {}
+        for shard in shards:
+            for name, timer in list(shard.items()):
+                if name not in timers:
+                    timers[name] = self._timer_obj()
+                timers[name].merge(timer)
+        return timers
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        name = self.context_stacks.pop(-1)
-        self.toc(name)
-        if exc_type is not None:
-            raise exc_value
+    @property
+    def timer_tree(self):
+        """
+        Inclusive and exclusive (self) time of every timer path, where a path
+        is the tuple of timer names from the outermost running timer down.
+        The paths of a sampled timer are extrapolated to all its calls, like
+        its estimated_total_time; `sampled` counts the timed calls.
+        """
+        with self._lock:
+            shards = list(self._path_shards)
+        scales = {}
+        for name, timer in self.timers.items():
+            if timer.skipped and timer.calls:
+                scales[name] = timer.total_calls / timer.calls
+        totals = defaultdict(lambda: [0, 0])
+        for shard in shards:
+            for path, (total_ns, calls, pending) in list(shard.items()):
+                if pending:
+                    total_ns = self._resolve_path(shard, path)
+                totals[path][0] += total_ns
+                totals[path][1] += calls
+        for path, total in totals.items():
+            scale = scales.get(path[-1], 1.)
+            total.append(round(total[0] * scale))
+        children_ns = defaultdict(int)
+        for path, (_, _, estimated_ns) in totals.items():
+            if len(path) > 1:
+                children_ns[path[:-1]] += estimated_ns
+        return {
+            path: dict(calls=round(calls * scales.get(path[-1], 1.)), sampled=calls,
+                       inclusive=estimated_ns * NS,
+                       exclusive=(estimated_ns - children_ns[path]) * NS)
+            for path, (_, calls, estimated_ns) in sorted(totals.items()) if calls
+        }
+
+    def _reset_shards(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = []
+        self._path_shards = []
+        self._span_shards = []
+        # end of the last batched sync, where the current step started
+        self._step_ns = self.clock()
+        # read from the current clock, whose origin is arbitrary
+        self._last_log_ns = self.clock()
+
+    def _shard(self):
+        # each thread owns its timers, so the hot path never takes a lock
+        try:
+            return self._local.timers
+        except AttributeError:
+            timers = _TimerShard(self)
+            paths = {}
+            spans = []
+            with self._lock:
+                self._shards.append(timers)
+                self._path_shards.append(paths)
+                self._span_shards.append(spans)
+            self._local.timers = timers
+            self._local.paths = paths
+            self._local.spans = spans
+            self._local.handles = {}
+            return timers
+
+    def _record_path(self, name, timer, entry=None):
+        path = _timer_path.get()
+        if name not in path:
+            return None
+        index = len(path) - 1 - path[::-1].index(name)
+        _timer_path.set(path[:index] + path[index + 1:])
+        if timer is None:
+            return
+        key = path[:index + 1]
+        node = self._local.paths.get(key)
+        if node is None:
+            node = self._local.paths[key] = [0, 0, []]
+        node[1] += 1
+        if self.batched:
+            return node  # the time is added by flush()
+        if self.events is not None:
+            # not pending[-1], another thread may have resolved it already
+            node[2].append(entry)
+        else:
+            node[0] += timer.deque[-1]
+        return node
+
+    def _resolve_path(self, shard, path):
+        node = shard[path]
+        with _resolve_lock:
+            pending = node[2][:len(node[2])]
+            del node[2][:len(pending)]
+            if pending:
+                self.events.wait(pending[-1][1])
+            for start, end, _ in pending:
+                node[0] += max(self.events.elapsed_ns(start, end) - self.overhead_ns, 0)
+        return node[0]
+
+    def _new_timer(self, name):
+        timer = self._timer_obj()
+        if self.trace is not None:
+            timer.trace_id = self.trace.timer_id(name)
+        if name in self._sampling:
+            timer.set_sampling(*self._sampling[name])
+        return timer
+
+    def set_sampling(self, name, every=1, probability=None):
+        """
+        Time only one in `every` calls of timer `name`, or each call with
+        `probability`. log() extrapolates the total time to all calls.
+        """
+        self._sampling[name] = (every, probability)
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            if name in shard:
+                shard[name].set_sampling(every, probability)
 
     def set_sync_func(self, func):
         assert isinstance(func, Callable)
         self.sync = func
+        self._update_plain()
+
+    def _update_plain(self):
+        # tic/toc only read the clock, see the fast paths of _tic and _toc
+        self._plain = (self.enabled and self.sync is _noop and not self.tree
+                       and self.events is None and not self.batched
+                       and self.trace is None and self.calls >= self.num_warmup)
 
     def set_window_size(self, window_size):
         assert isinstance(window_size, int)
         assert len(self.timers) == 0
         self.window_size = window_size
-        timer_obj = partial(Timer, window_size=self.window_size) \
-            if window_size > 0 else Timer
-        self.timers = defaultdict(timer_obj)
+        self._timer_obj = self._timer_factory()
+        self._reset_shards()
+
+    def set_clock(self, func):
+        """
+        Set the clock source, a callable returning integer nanoseconds.
+        """
+        assert isinstance(func, Callable)
+        assert len(self.timers) == 0
+        self.clock = func
+        self._timer_obj = self._timer_factory()
+        self._reset_shards()
+
+    def set_ring_buffer(self, enabled):
+        """
+        Back the timer windows with preallocated arrays instead of deques.
+        """
+        assert isinstance(enabled, bool)
+        assert len(self.timers) == 0
+        self.ring_buffer = enabled
+        self._timer_obj = self._timer_factory()
+        self._reset_shards()
+
+    def set_sketch(self, enabled):
+        """
+        Keep a QuantileSketch on every timer, for quantiles over the whole
+        run (and the metrics buckets) instead of over the window.
+        """
+        assert isinstance(enabled, bool)
+        assert len(self.timers) == 0
+        self.sketch = enabled
+        self._timer_obj = self._timer_factory()
+        self._reset_shards()
+
+    def set_histogram(self, enabled):
+        """
+        Keep a LogLinearHistogram on every timer, as `timer.histogram`.
+        """
+        assert isinstance(enabled, bool)
+        assert len(self.timers) == 0
+        self.histogram = enabled
+        self._timer_obj = self._timer_factory()
+        self._reset_shards()
+
+    def set_time_window(self, seconds, buckets=60):
+        """
+        Window the timers over the last `seconds` of wall time, kept in
+        `buckets` ring slots, instead of over the last `window_size` calls.
+        log() then reports averages over that time window.
+        """
+        assert len(self.timers) == 0
+        assert seconds is None or seconds > 0
+        self.time_window = seconds
+        self.time_buckets = buckets
+        self._timer_obj = self._timer_factory()
+        self._reset_shards()
+
+    def set_enabled(self, enabled):
+        """
+        Switch timing on or off. While off, tic/toc are bound to no-ops and
+        `debug_timer(name)` returns a shared null context.
+        """
+        assert isinstance(enabled, bool)
+        self.enabled = enabled
+        for name in [name for name in self.__dict__ if name.endswith(("_tic", "_toc"))]:
+            del self.__dict__[name]
+        if enabled:
+            for name in ("tic", "toc", "log"):
+                self.__dict__.pop(name, None)
+        else:
+            self.__dict__.update(tic=_noop, toc=_noop, log=_noop)
+        self._update_plain()
+
+    def enable(self):
+        self.set_enabled(True)
+
+    def disable(self):
+        self.set_enabled(False)
+
+    def set_tree(self, enabled):
+        """
+        Track the nesting of timers, see `timer_tree`.
+        """
+        assert isinstance(enabled, bool)
+        self.tree = enabled
+        self._update_plain()
+
+    def calibrate(self, iterations=10000):
+        """
+        Measure the cost of an empty tic/toc under the current configuration
+        (sync func, clock, tree, ...) and subtract it from every sample from
+        now on. Call it once after configuring the timer. Returns seconds.
+        """
+        assert self.enabled
+        name = "__calibration__"
+        self.set_overhead(0)
+        num_warmup, self.num_warmup = self.num_warmup, 0
+        self._update_plain()
+        diffs = np.empty(iterations, dtype=np.int64)
+        try:
+            timer = self.tic(name)
+            self.toc(name)
+            for i in range(iterations):
+                self.tic(name)
+                self.toc(name)
+                if self.batched:
+                    self.flush()
+                timer.resolve()
+                diffs[i] = timer.deque[-1]
+        finally:
+            self.num_warmup = num_warmup
+            self._update_plain()
+            self._shard().pop(name, None)
+            self._local.paths.pop((name,), None)
+        self.set_overhead(int(np.median(diffs)))
+        return self.overhead
+
+    @property
+    def overhead(self):
+        """
+        The calibrated tic/toc overhead in seconds.
+        """
+        return self.overhead_ns * NS
+
+    def set_overhead(self, overhead_ns):
+        assert isinstance(overhead_ns, int) and overhead_ns >= 0
+        self.overhead_ns = overhead_ns
+        self._timer_obj = self._timer_factory()
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for timer in list(shard.values()):
+                timer.overhead_ns = overhead_ns
+
+    def set_events(self, events):
+        """
+        Time with an EventBackend instead of syncing around every tic/toc,
+        eg. debug_timer.set_events(CudaEventBackend()). Pass None to go back
+        to the clock and sync func.
+        """
+        assert events is None or isinstance(events, EventBackend)
+        assert len(self.timers) == 0
+        assert events is None or not self.batched
+        assert events is None or self.trace is None
+        self.events = events
+        self._blocking = events is None and not self.batched
+        self._timer_obj = self._timer_factory()
+        self._reset_shards()
+        self._update_plain()
+
+    def set_batched(self, enabled):
+        """
+        Record host timestamps only and sync once per step, in log() (or an
+        explicit flush()), instead of around every tic/toc.
+        """
+        assert isinstance(enabled, bool)
+        assert not enabled or self.events is None
+        self.batched = enabled
+        self._blocking = not enabled
+        self._step_ns = self.clock()
+        self._update_plain()
+
+    def share(self, table, slot=None):
+        """
+        Publish the aggregates of this process into slot `slot` of a
+        SharedTimerTable, at every log period and on publish(). Publishing
+        raises ValueError when the timers overflow the table's max_timers or
+        max_name_len.
+        """
+        assert isinstance(table, SharedTimerTable)
+        self.shared_slot = table.claim(slot)
+        self.shared = table
+
+    def publish(self):
+        self.shared.write(self.shared_slot, self.timers)
+
+    def set_trace(self, recorder):
+        """
+        Record every timed span into a TraceRecorder, or stop with None.
+        The recorder is closed by its owner.
+        """
+        assert recorder is None or isinstance(recorder, TraceRecorder)
+        assert recorder is None or self.events is None
+        self.trace = recorder
+        self._update_plain()
+        if recorder is None:
+            return
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for name, timer in list(shard.items()):
+                timer.trace_id = recorder.timer_id(name)
+
+    def _trace_buffer(self):
+        buffer = getattr(self._local, "trace", None)
+        if buffer is None or buffer.recorder is not self.trace:
+            buffer = self._local.trace = self.trace.new_buffer()
+        return buffer
+
+    def export_chrome_trace(self, path, chunk_size=1 << 16):
+        """
+        Flush the current TraceRecorder and write its spans to `path` as
+        Chrome trace JSON, see `write_chrome_trace`.
+        """
+        self.trace.flush()
+        write_chrome_trace(self.trace.records(), self.trace.names(), path, chunk_size)
+
+    def render_metrics(self):
+        """
+        The timers in the OpenMetrics text format, see MetricsExporter.
+        """
+        return self.metrics.render()
+
+    def serve_metrics(self, port=9464, addr="", exporter=None):
+        """
+        Serve `render_metrics()` over HTTP, eg. for a Prometheus scraper.
+        """
+        if exporter is not None:
+            self.metrics = exporter
+        return self.metrics.serve(port, addr)
+
+    def start_reporter(self, interval=10., prefix="", log_func=print):
+        """
+        Report from a background thread every `interval` seconds instead of
+        inline; log() then only counts steps (and flushes batched spans).
+        """
+        assert self.reporter is None
+        self.reporter = Reporter(self, interval, prefix, log_func).start()
+        return self.reporter
+
+    def stop_reporter(self):
+        self.reporter.stop()
+        self.reporter = None
+
+    def set_communicator(self, comm):
+        """
+        Reduce the timers across ranks in log(), see `reduce_ranks`. The
+        reduction is collective and runs every `logperiod` calls, even with
+        an `interval`, so every rank has to call log() alike.
+        """
+        assert comm is None or isinstance(comm, Communicator)
+        self.comm = comm
+
+    def reduce_ranks(self):
+        """
+        Gather every rank's count, sum, min, max and sketch of each timer and
+        reduce them on rank 0: min/mean/max of the per-rank averages, the
+        slowest (straggler) rank and the quantiles over all ranks (None
+        without set_sketch). Collective, every rank has to call it; ranks
+        other than 0 get None.
+        """
+        stats = {}
+        for name, timer in self.timers.items():
+            if timer.pending:
+                timer.resolve()
+            stats[name] = (timer.calls, timer.total_ns, timer.min_ns, timer.max_ns, timer.sketch)
+        gathered = self.comm.gather(stats)
+        if gathered is None:
+            return None
+        reduced = {}
+        names = dict.fromkeys(name for stats in gathered for name in stats)
+        for name in names:
+            ranks = [rank for rank, stats in enumerate(gathered) if name in stats]
+            rows = [gathered[rank][name] for rank in ranks]
+            avgs = np.array([total_ns / calls if calls else 0. for calls, total_ns, _, _, _ in rows])
+            sketches = [row[4] for row in rows if row[4] is not None]
+            sketch = QuantileSketch(sketches[0].relative_accuracy) if sketches else None
+            for other in sketches:
+                sketch.merge(other)
+            reduced[name] = dict(
+                calls=sum(row[0] for row in rows),
+                min=float(avgs.min()) * NS, mean=float(avgs.mean()) * NS,
+                max=float(avgs.max()) * NS, straggler=ranks[int(avgs.argmax())],
+                global_min=min(row[2] for row in rows) * NS,
+                global_max=max(row[3] for row in rows) * NS,
+                p50=sketch.quantile(0.5) * NS if sketch is not None else None,
+                p99=sketch.quantile(0.99) * NS if sketch is not None else None)
+        return reduced
+
+    def _timer_factory(self):
+        kwargs = dict(clock=self.clock, ring_buffer=self.ring_buffer,
+                      overhead_ns=self.overhead_ns, events=self.events,
+                      histogram=self.histogram, time_window=self.time_window,
+                      time_buckets=self.time_buckets, sketch=self.sketch)
+        if self.window_size > 0:
+            kwargs["window_size"] = self.window_size
+        return partial(Timer, **kwargs)
 
     def reset_timer(self):
-        for timer in self.timers.values():
-            timer.reset()
+        with self._lock:
+            shards = list(self._shards)
+            path_shards = list(self._path_shards)
+        for shard in shards:
+            for timer in list(shard.values()):
+                timer.reset()
+        for paths in path_shards:
+            # in place, the owner thread may be adding to a node meanwhile
+            for node in list(paths.values()):
+                node[0], node[1] = 0, 0
+                del node[2][:]
+
+    def handle(self, name):
+        """
+        A TimerHandle of `name` for the calling thread, its Timer is
+        resolved on first use. Handles belong to the thread which created
+        them; the set_* methods drop every timer, so don't keep a handle
+        used before configuring.
+        """
+        try:
+            return self._local.handles[name]
+        except AttributeError:
+            self._shard()
+        except KeyError:
+            pass
+        handle = self._local.handles[name] = TimerHandle(self, name)
+        return handle
+
+    def decorator(self, name, per_yield=False):
+        """
+        Like `@debug_timer(name)`, optionally timing every step of a
+        generator separately, as `name + ".yield"`.
+        """
+        if not self.enabled:
+            return _null_timer
+        return partial(_timed, self, name, per_yield=per_yield)
+
+    def instrument(self, target, include=None, exclude=None, per_yield=False):
+        """
+        Time every function and method of a module or class, each as its
+        qualified name (eg. "pkg.mod.Class.method"). For a module, only the
+        functions and classes defined in it are instrumented. `include` and
+        `exclude` are fnmatch patterns (or lists of them) on the qualified
+        name; dunder methods are skipped. References imported elsewhere
+        before the call keep the original. Returns the number of wrapped
+        functions; undo with `uninstrument`.
+        """
+        assert inspect.ismodule(target) or inspect.isclass(target)
+        patches = self._instrumented.setdefault(target, [])
+        num_patches = len(patches)
+        for owner, attr, value, func in _iter_functions(target, include, exclude):
+            if getattr(func, "__debug_timer__", False):
+                continue
+            wrapped = _timed(self, _qualname(func), func, per_yield)
+            wrapped.__debug_timer__ = True
+            if not inspect.isfunction(value):
+                wrapped = type(value)(wrapped)  # staticmethod or classmethod
+            patches.append((owner, attr, value))
+            setattr(owner, attr, wrapped)
+        return len(patches) - num_patches
+
+    def profile(self, *targets, include=None, exclude=None, use_monitoring=None):
+        """
+        Start a FunctionProfiler timing the functions of `targets` (modules,
+        classes or functions) into this debug timer, stop it with its
+        stop() or use it as a context manager.
+        """
+        return FunctionProfiler(self, targets, include, exclude, use_monitoring).start()
+
+    def uninstrument(self, target=None):
+        """
+        Restore the originals replaced by `instrument(target)`, or by every
+        instrument call.
+        """
+        targets = list(self._instrumented) if target is None else [target]
+        for target in targets:
+            for owner, attr, original in reversed(self._instrumented.pop(target, [])):
+                setattr(owner, attr, original)
 
     def tic(self, name):
-        timer = self.timers[name]
-        self.sync()
+        try:
+            timer = self._local.timers[name]
+        except AttributeError:
+            timer = self._shard()[name]
+        return self._tic(name, timer)
+
+    def _tic(self, name, timer):
+        if self._plain and not timer.sampling:
+            timer.start_ns = timer.clock()
+            return timer
+        if timer.sampling and not timer.should_sample():
+            timer.sampled = False
+            if self.tree:
+                # the children of a skipped call still nest under it
+                _timer_path.set(_timer_path.get() + (name,))
+            return timer
+        timer.sampled = True
+        if self.tree:
+            _timer_path.set(_timer_path.get() + (name,))
+        if self._blocking:
+            self.sync()
         timer.tic()
         return timer
 
-    def toc(self, name):
-        timer = self.timers.get(name, None)
+    def toc(self, name, start_ns=None):
+        try:
+            timer = self._local.timers.get(name, None)
+        except AttributeError:
+            timer = None
         if timer is None:
             raise ValueError(
                 f"Trying to toc a non-existent Timer which is named '{name}'!")
+        return self._toc(name, timer, start_ns)
+
+    def _toc(self, name, timer, start_ns=None):
+        if self._plain and not timer.sampling:
+            return timer.toc(start_ns)
+        if start_ns is None and not timer.sampled:
+            if self.tree:
+                self._record_path(name, None)
+            return None
         if self.calls >= self.num_warmup:
-            self.sync()
-            return timer.toc()
+            if self.batched:
+                end_ns = timer.clock()
+                node = self._record_path(name, timer) if self.tree else None
+                start_ns = timer.start_ns if start_ns is None else start_ns
+                self._local.spans.append((timer, node, start_ns, end_ns))
+                if self.trace is not None:
+                    self._trace_buffer().record(timer.trace_id, start_ns, end_ns)
+                return None
+            if self._blocking:
+                self.sync()
+            if self.events is not None:
+                entry = timer.toc(start_ns)
+                if self.tree:
+                    self._record_path(name, timer, entry)
+                return None
+            diff = timer.toc(start_ns)
+            if self.tree:
+                self._record_path(name, timer)
+            if self.trace is not None:
+                start_ns = timer.start_ns if start_ns is None else start_ns
+                self._trace_buffer().record(
+                    timer.trace_id, start_ns, start_ns + timer.deque[-1])
+            return diff
+        if self.tree:
+            self._record_path(name, None)
 
-    def log(self, logperiod=10, prefix="", log_func=print):
+    def flush(self):
         """
-        Log the tracked statistics.
+        End a step in batched mode: sync once, then turn the host timestamps
+        recorded by every thread since the last flush into samples.
+
+        The host runs ahead of the device, which drains its queue during
+        the sync. Only the sync itself is timed: assuming the device lag
+        grew evenly from the end of the last sync t0 to the start of this
+        one t1, each timestamp t maps to
+            t + drain * (t - t0) / (t1 - t0)
+        so every span is stretched by 1 + drain / (t1 - t0). With a no-op
+        sync the host timestamps are used as they are.
+        """
+        spans = []
+        with self._lock:
+            for shard in self._span_shards:
+                # consume in place, the owner thread may append meanwhile
+                num_spans = len(shard)
+                spans.extend(shard[:num_spans])
+                del shard[:num_spans]
+        sync_start_ns = self.clock()
+        self.sync()
+        sync_ns = self.clock()
+        step_ns, self._step_ns = self._step_ns, sync_ns
+        step_len_ns = sync_start_ns - step_ns
+        scale = (sync_ns - sync_start_ns) / step_len_ns if step_len_ns > 0 else 0.
+        with _resolve_lock:
+            for timer, node, start_ns, end_ns in spans:
+                diff = max(int((end_ns - start_ns) * (1. + scale)) - timer.overhead_ns, 0)
+                timer.add(diff, end_ns)
+                if node is not None:
+                    node[0] += diff
+
+    def log(self, logperiod=10, prefix="", log_func=print, interval=None):
+        """
+        Log the tracked statistics every `logperiod` calls, or every
+        `interval` seconds of wall time when given.
         Eg.: | timer1: xxxs | timer2: xxxms | timer3: xxxms |
+        With the timer tree enabled, one indented line per timer path.
         """
+        if self.batched:
+            self.flush()
         self.calls += 1
-        if self.calls % logperiod == 0 and self.timers:
-            lines = [prefix or self.prefix]
-            for name, timer in self.timers.items():
-                avg_time = timer.avg if self.window_size > 0 else timer.global_avg
-                suffix = "s"
-                if avg_time < 0.01:
-                    avg_time *= 1000
-                    suffix = "ms"
-                lines.append(" {}: {:.3f}{} ".format(name, avg_time, suffix))
-            lines.append("")
-            log_func("|".join(lines))
+        if self.calls == self.num_warmup:
+            self._update_plain()
+        if interval is None:
+            due = self.calls % logperiod == 0
+        else:
+            now_ns = self.clock()
+            due = now_ns - self._last_log_ns >= interval / NS
+            if due:
+                self._last_log_ns = now_ns
+        if due and self.shared is not None:
+            self.publish()
+        if self.comm is not None:
+            # collective: every rank joins on the same call, timers or not
+            if self.calls % logperiod == 0:
+                self._log_ranks(prefix or self.prefix, log_func)
+            return
+        # a running reporter does the printing
+        if self.reporter is not None:
+            return
+        if due and self.timers:
+            if self.tree:
+                log_func(self._format_tree(prefix or self.prefix))
+                return
+            log_func(self._format_line(
+                prefix or self.prefix, self.timers, self.window_size > 0))
+
+    def log_shared(self, table=None, prefix="", log_func=print):
+        """
+        Log the whole-run averages merged over every process of `table`.
+        """
+        table = self.shared if table is None else table
+        timers = table.timers()
+        if timers:
+            log_func(self._format_line(prefix or self.prefix, timers, False))
+
+    def _log_ranks(self, prefix, log_func):
+        """
+        Eg.: | timer1: xxxms [xxxms, xxxms @3] |
+        The mean over ranks, then the fastest and slowest rank averages.
+        """
+        reduced = self.reduce_ranks()
+        if not reduced:
+            return
+        lines = [prefix]
+        for name, stats in reduced.items():
+            lines.append(" {}: {} [{}, {} @{}] ".format(
+                name, _format_time(stats["mean"]), _format_time(stats["min"]),
+                _format_time(stats["max"]), stats["straggler"]))
+        lines.append("")
+        log_func("|".join(lines))
+
+    def _format_line(self, prefix, timers, windowed):
+        lines = [prefix]
+        for name, timer in timers.items():
+            if not windowed:
+                avg_time = timer.global_avg
+            elif timer.time_window is not None:
+                avg_time = timer.recent_avg
+            else:
+                avg_time = timer.avg
+            if timer.skipped:
+                lines.append(" {}: {} (total {} over {} calls) ".format(
+                    name, _format_time(avg_time),
+                    _format_time(timer.estimated_total_time), timer.total_calls))
+            else:
+                lines.append(" {}: {} ".format(name, _format_time(avg_time)))
+        lines.append("")
+        return "|".join(lines)
+
+    def _format_tree(self, prefix):
+        """
+        Eg.: step: xxxms (self xxxms)
+               forward: xxxms (self xxxms)
+        """
+        lines = [prefix] if prefix else []
+        for path, node in self.timer_tree.items():
+            line = "{}{}: {} (self {})".format(
+                "  " * (len(path) - 1), path[-1],
+                _format_time(node["inclusive"] / node["calls"]),
+                _format_time(node["exclusive"] / node["calls"]))
+            if node["sampled"] != node["calls"]:
+                line += " (total {} over {} calls)".format(
+                    _format_time(node["inclusive"]), node["calls"])
+            lines.append(line)
+        return "\n".join(lines)
 
 
 debug_timer = _DebugTimer()